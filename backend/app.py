@@ -1,16 +1,119 @@
 import os
 import time
+import queue
+import atexit
+import asyncio
+import logging
+import logging.handlers
+import secrets
+import itertools
 import threading
-import requests
-from flask import Flask, request, jsonify
+import httpx
+import orjson
+import concurrent.futures
+from hashlib import blake2b
+from functools import lru_cache
+from collections import deque
+from io import BytesIO
+from tempfile import TemporaryFile
+from urllib.parse import quote
+from cachetools import LRUCache
+from PIL import Image
+from flask import Flask, Request, request, jsonify
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
-from supabase import create_client, Client
+from supabase import create_client, Client, ClientOptions, PostgrestAPIError
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# =========================
+# LOGGING
+# =========================
+# Handlers only enqueue records; a single listener thread writes them out so
+# request and storage threads never block on stdout.
+log_queue = queue.SimpleQueue()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+# Wired by hand: basicConfig would give the QueueHandler its own formatter,
+# and its prefix would end up baked into every queued message.
+root_logger = logging.getLogger()
+root_logger.setLevel(logging.INFO)
+root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+# httpx logs every request at INFO; keep only its warnings
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
+
+# =========================
+# JSON (ORJSON)
+# =========================
+# jsonify() and request.json go through app.json; orjson encodes straight to
+# bytes and is much faster than the stdlib json module.
+class OrjsonProvider(JSONProvider):
+    option = orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=self.option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, option=self.option),
+            mimetype="application/json"
+        )
+
+
+# =========================
+# UPLOAD LIMITS
+# =========================
+# Werkzeug spools uploads to disk past 500KB. Camera frames are usually a
+# couple of MB, so keep them in memory and reject anything oversized before
+# the multipart parser runs.
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024
+UPLOAD_SPOOL_SIZE = 4 * 1024 * 1024
+
+
+class UploadRequest(Request):
+    # Same as werkzeug's default_stream_factory with a larger in-memory limit.
+    # A SpooledTemporaryFile would not work here: httpx calls fileno() on the
+    # stream to size the multipart body, which rolls it over to disk.
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if total_content_length is not None and total_content_length <= UPLOAD_SPOOL_SIZE:
+            return BytesIO()
+        return TemporaryFile("rb+")
+
+
 app = Flask(__name__)
-CORS(app)
+app.request_class = UploadRequest
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_SIZE
+app.json = OrjsonProvider(app)
+
+# Comma-separated list of dashboard origins; unset keeps the old allow-all.
+# max_age lets browsers cache the preflight instead of repeating it.
+FRONTEND_ORIGINS = [o.strip() for o in os.getenv("FRONTEND_ORIGINS", "*").split(",") if o.strip()]
+
+CORS(
+    app,
+    resources={
+        r"/predict": {"origins": FRONTEND_ORIGINS},
+        r"/save-.*": {"origins": FRONTEND_ORIGINS},
+        r"/health": {"origins": "*"}
+    },
+    methods=["GET", "POST"],
+    max_age=86400
+)
+
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    return jsonify({"error": "Image too large"}), 413
 
 # =========================
 # CONFIG
@@ -19,71 +122,386 @@ SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_KEY")
 MODEL_URL = os.getenv("MODEL_URL")  # HF Docker Space endpoint
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
+# One HTTP/2 client shared by the Supabase sub-clients, so DB inserts from
+# every thread reuse the same connections.
+SUPABASE_HTTP = httpx.Client(
+    http2=True,
+    limits=httpx.Limits(max_connections=40, max_keepalive_connections=20),
+    timeout=30
+)
+
+supabase: Client = create_client(
+    SUPABASE_URL,
+    SUPABASE_SERVICE_KEY,
+    options=ClientOptions(httpx_client=SUPABASE_HTTP)
+)
+
+# The Postgrest sub-client is created lazily on first access; build it here
+# so concurrent threads never race to create duplicates.
+supabase.postgrest
+
+# =========================
+# HTTP CLIENT (HF MODEL)
+# =========================
+# Shared HTTP/2 client so /predict multiplexes requests to the HF Space over
+# a persistent connection instead of opening a new one per request.
+HTTP_CLIENT = httpx.Client(
+    transport=httpx.HTTPTransport(
+        http2=True,
+        retries=2,
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20)
+    ),
+    timeout=120
+)
+# Bound once so /predict skips the attribute lookup on every call
+_model_post = HTTP_CLIENT.post
+
+# =========================
+# PREDICTION CACHE
+# =========================
+# Motion-triggered cameras often resend the same frame; identical images are
+# answered from memory instead of another round-trip to the HF Space.
+PRED_CACHE = LRUCache(maxsize=int(os.getenv("PRED_CACHE_SIZE", 1024)))
+PRED_CACHE_LOCK = threading.Lock()
+
+
+def image_digest(stream):
+    digest = blake2b(digest_size=16)
+    for chunk in iter(lambda: stream.read(64 * 1024), b""):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.digest()
+
+
+# Consecutive frames from the same camera rarely match byte-for-byte, so each
+# user also keeps a short history of 64-bit dHashes. A new frame within a few
+# bits of a recent one reuses that frame's label.
+RECENT_FRAMES = LRUCache(maxsize=int(os.getenv("FRAME_CACHE_USERS", 1024)))
+RECENT_FRAMES_LOCK = threading.Lock()
+FRAME_HISTORY = 16
+FRAME_MAX_DISTANCE = 6
+FRAME_MAX_AGE = 5.0  # seconds
+FRAME_MAX_PIXELS = 12_000_000  # larger images are sent to the model unhashed
+
+
+def image_dhash(stream):
+    try:
+        with Image.open(stream) as img:
+            # Only JPEGs can be decoded at reduced scale via draft(); any other
+            # format would be fully decoded on the request thread, so skip it
+            if img.format != "JPEG" or img.size[0] * img.size[1] > FRAME_MAX_PIXELS:
+                return None
+            img.draft("L", (9, 8))
+            thumb = img.convert("L").resize((9, 8))
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    finally:
+        stream.seek(0)
+
+    pixels = thumb.tobytes()
+    value = 0
+    for row in range(0, 72, 9):
+        for col in range(row, row + 8):
+            value = (value << 1) | (pixels[col] > pixels[col + 1])
+    return value
+
+
+def match_recent_frame(user_id, frame_hash):
+    now = time.monotonic()
+    with RECENT_FRAMES_LOCK:
+        frames = list(RECENT_FRAMES.get(user_id, ()))
+
+    for prev_hash, animal, confidence, seen_at in reversed(frames):
+        if now - seen_at > FRAME_MAX_AGE:
+            break
+        if bin(frame_hash ^ prev_hash).count("1") <= FRAME_MAX_DISTANCE:
+            return animal, confidence
+    return None
+
+
+def remember_frame(user_id, frame_hash, animal, confidence):
+    with RECENT_FRAMES_LOCK:
+        frames = RECENT_FRAMES.get(user_id)
+        if frames is None:
+            frames = RECENT_FRAMES[user_id] = deque(maxlen=FRAME_HISTORY)
+        frames.append((frame_hash, animal, confidence, time.monotonic()))
+
+
+# =========================
+# BATCHED DB INSERTS
+# =========================
+# Rows for labeled_images from background /predict storage are coalesced over
+# a short window and written with one insert call instead of one round-trip
+# per detection. The save endpoints insert directly so callers see failures.
+INSERT_Q = queue.Queue()
+INSERT_WINDOW = 0.2  # seconds
+INSERT_BATCH_MAX = 100
+_INSERT_STOP = object()
+
+
+def insert_worker():
+    stopping = False
+    while not stopping:
+        record = INSERT_Q.get()
+        if record is _INSERT_STOP:
+            break
+
+        batch = [record]
+        deadline = time.monotonic() + INSERT_WINDOW
+        while len(batch) < INSERT_BATCH_MAX:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                record = INSERT_Q.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if record is _INSERT_STOP:
+                stopping = True
+                break
+            batch.append(record)
+
+        insert_batch(batch)
+
+
+def insert_rows(rows):
+    supabase.table("labeled_images").insert(rows).execute()
+
+
+def insert_batch(batch):
+    try:
+        insert_rows(batch)
+    except PostgrestAPIError:
+        # PostgREST rejected the request; a bulk insert is all-or-nothing, so
+        # retry row by row and drop only the rows it refuses
+        if len(batch) == 1:
+            logger.exception("Insert error for user %s", batch[0]["user_id"])
+            return
+        logger.warning("Batch insert of %d rows rejected; retrying one at a time", len(batch))
+        stored = 0
+        for index, row in enumerate(batch):
+            try:
+                insert_rows([row])
+                stored += 1
+            except PostgrestAPIError:
+                logger.exception("Insert error for user %s", row["user_id"])
+            except Exception:
+                logger.exception("Batch insert failed, %d detections lost", len(batch) - index)
+                break
+        logger.info("Stored %d of %d detections", stored, len(batch))
+    except Exception:
+        # Network or server failure: single-row retries would fail the same way
+        logger.exception("Batch insert failed, %d detections lost", len(batch))
+    else:
+        logger.info("Stored %d detections", len(batch))
+
+
+insert_thread = threading.Thread(target=insert_worker, name="inserts", daemon=True)
+insert_thread.start()
+
+
+def stop_insert_worker():
+    # Anything queued before the sentinel is still written
+    INSERT_Q.put(_INSERT_STOP)
+    insert_thread.join(timeout=30)
+
+
+# Registered before the storage loop so it runs after uploads have drained
+atexit.register(stop_insert_worker)
 
 # =========================
 # BACKGROUND STORAGE TASK
 # =========================
-def background_storage(image_bytes, filename, mimetype, animal, confidence, user_id):
+# Uploads run as coroutines on one event loop thread, so hundreds of
+# in-flight detections share a few HTTP/2 connections instead of each tying
+# up a worker thread while it waits on Supabase.
+STORAGE_LOOP = asyncio.new_event_loop()
+threading.Thread(target=STORAGE_LOOP.run_forever, name="storage", daemon=True).start()
+
+
+async def _make_slots(count):
+    # Created on the storage loop so it binds to that loop on Python < 3.10
+    return asyncio.Semaphore(count)
+
+
+def storage_slots(count):
+    return asyncio.run_coroutine_threadsafe(_make_slots(count), STORAGE_LOOP).result()
+
+
+# Caps concurrent background uploads, like the worker pool this loop
+# replaced. /save-detection waits on its upload, so it gets separate slots
+# and a burst of background uploads cannot stall it.
+STORAGE_SLOTS = storage_slots(int(os.getenv("STORAGE_WORKERS", 8)))
+SAVE_SLOTS = storage_slots(int(os.getenv("SAVE_UPLOAD_WORKERS", 4)))
+
+STORAGE_HTTP = httpx.AsyncClient(
+    http2=True,
+    headers={
+        "apikey": SUPABASE_SERVICE_KEY,
+        "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}"
+    },
+    limits=httpx.Limits(max_connections=40, max_keepalive_connections=20),
+    timeout=30
+)
 
+
+async def _drain_storage():
+    pending = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+    await asyncio.gather(*pending, return_exceptions=True)
+    await STORAGE_HTTP.aclose()
+
+
+def stop_storage_loop():
+    # Let queued uploads finish before the process exits
+    asyncio.run_coroutine_threadsafe(_drain_storage(), STORAGE_LOOP).result(timeout=60)
+    STORAGE_LOOP.call_soon_threadsafe(STORAGE_LOOP.stop)
+
+
+atexit.register(stop_storage_loop)
+
+
+# Public object URLs are deterministic, so build them from a fixed prefix
+# instead of going through the storage client on every upload.
+_PUBLIC_PREFIXES = {
+    bucket: f"{SUPABASE_URL}/storage/v1/object/public/{bucket}/"
+    for bucket in ("captured-images",)
+}
+
+
+def public_url(bucket, filename):
+    return _PUBLIC_PREFIXES[bucket] + quote(filename)
+
+
+# Confidence values arrive as a small set of repeated strings, so parsed
+# results are cached rather than re-running float() on every request.
+@lru_cache(maxsize=2048)
+def parse_confidence(value):
+    return float(value)
+
+
+def valid_confidence(value):
+    # labeled_images.confidence_score is constrained to 0-100
     try:
-        bucket = "captured-images"
+        score = parse_confidence(value)
+    except (TypeError, ValueError):
+        return None
+    return score if 0 <= score <= 100 else None
+
+
+_fname_seq = itertools.count()
+
+
+def storage_filename(original):
+    # Counter + random suffix stays unique across concurrent requests and
+    # worker processes, unlike a per-second timestamp.
+    return f"{next(_fname_seq):08x}_{secrets.token_hex(4)}_{original}"
+
+
+def labeled_row(image_url, animal, confidence, user_id):
+    return {
+        "labeled_image_url": image_url,
+        "animal_detected": animal,
+        "confidence_score": parse_confidence(confidence),
+        "user_id": user_id
+    }
+
+
+def save_record(image_url, animal, confidence, user_id):
+    # Insert now so the endpoint can report database errors to its caller
+    insert_rows([labeled_row(image_url, animal, confidence, user_id)])
 
-        # Upload image to Supabase Storage
-        supabase.storage.from_(bucket).upload(
-            filename,
-            image_bytes,
-            {"content-type": mimetype}
+
+async def upload_image(image_bytes, filename, mimetype, bucket, slots=STORAGE_SLOTS):
+    # Single storage path for every endpoint; returns the public URL
+    async with slots:
+        upload = await STORAGE_HTTP.post(
+            f"{SUPABASE_URL}/storage/v1/object/{bucket}/{quote(filename)}",
+            content=image_bytes,
+            headers={"content-type": mimetype}
         )
+        upload.raise_for_status()
 
-        public_url = supabase.storage.from_(bucket).get_public_url(filename)
+    return public_url(bucket, filename)
 
-        # Insert record into database
-        data = {
-            "labeled_image_url": public_url,
-            "animal_detected": animal,
-            "confidence_score": confidence,
-            "user_id": user_id
-        }
 
-        supabase.table("labeled_images").insert(data).execute()
+async def background_storage(image_bytes, filename, mimetype, animal, confidence, user_id):
 
-        print("Stored detection:", animal)
+    try:
+        image_url = await upload_image(image_bytes, filename, mimetype, "captured-images")
+        # Queue record for the batched insert into labeled_images
+        INSERT_Q.put(labeled_row(image_url, animal, confidence, user_id))
+        logger.info("Queued detection: %s", animal)
 
-    except Exception as e:
-        print("Background storage error:", e)
+    except Exception:
+        logger.exception("Background storage error")
 
 
 # =========================
-# PREDICT ENDPOINT (AI ONLY)
+# PREDICT ENDPOINT
 # =========================
+# Returns the model result only. An optional user_id form field also stores
+# the detection in the background (see docs/API_DOCUMENTATION.md); clients
+# that save through /save-history must not send it.
 @app.route("/predict", methods=["POST"])
 def predict():
-    if "image" not in request.files:
+    # request is a context-local proxy; resolve it once into locals
+    uploads = request.files
+    form = request.form
+    if "image" not in uploads:
         return jsonify({"error": "No image uploaded"}), 400
 
-    file = request.files["image"]
-    image_bytes = file.read()
+    file = uploads["image"]
+    stream = file.stream
     mimetype = file.mimetype
+    user_id = form.get("user_id")
 
     try:
-        # ===== SEND IMAGE TO HF DOCKER SPACE =====
-        files = {"image": (file.filename, image_bytes, mimetype)}
-
-        response = requests.post(
-            MODEL_URL,
-            files=files,
-            timeout=120
-        )
-
-        response.raise_for_status()
-
-        prediction = response.json()
-
-        animal = prediction.get("label", "Unknown")
-        confidence = float(prediction.get("confidence", 0)) * 100
-
-        # ===== RETURN RESULT IMMEDIATELY (NO STORAGE) =====
+        key = image_digest(stream)
+        with PRED_CACHE_LOCK:
+            cached = PRED_CACHE.get(key)
+
+        # Near-duplicate frames are only matched within one user's history
+        frame_hash = None
+        if cached is None and user_id:
+            frame_hash = image_dhash(stream)
+            if frame_hash is not None:
+                cached = match_recent_frame(user_id, frame_hash)
+
+        if cached is not None:
+            animal, confidence = cached
+        else:
+            # ===== SEND IMAGE TO HF DOCKER SPACE =====
+            # Stream straight from werkzeug's spooled upload instead of copying
+            # the whole image into a bytes buffer first.
+            files = {"image": (file.filename, stream, mimetype)}
+
+            response = _model_post(MODEL_URL, files=files)
+
+            response.raise_for_status()
+
+            prediction_get = response.json().get
+
+            animal = prediction_get("label", "Unknown")
+            confidence = float(prediction_get("confidence", 0)) * 100
+
+            with PRED_CACHE_LOCK:
+                PRED_CACHE[key] = (animal, confidence)
+            if frame_hash is not None:
+                remember_frame(user_id, frame_hash, animal, confidence)
+
+        # ===== STORE IN BACKGROUND (ONLY WHEN A USER IS GIVEN) =====
+        if user_id:
+            # The upload is closed once the request ends, so the background
+            # task gets its own copy of the bytes.
+            stream.seek(0)
+            image_bytes = stream.read()
+            filename = storage_filename(file.filename)
+            asyncio.run_coroutine_threadsafe(
+                background_storage(image_bytes, filename, mimetype, animal, confidence, user_id),
+                STORAGE_LOOP
+            )
+
+        # ===== RETURN RESULT IMMEDIATELY =====
         return jsonify({
             "status": "success",
             "animal": animal,
@@ -103,29 +521,23 @@ def save_history():
     if not data:
         return jsonify({"error": "No JSON data provided"}), 400
 
-    image_url = data.get("image_url")
-    animal = data.get("animal")
-    confidence = data.get("confidence")
-    user_id = data.get("user_id")
+    image_url, animal, confidence, user_id = map(
+        data.get, ("image_url", "animal", "confidence", "user_id")
+    )
 
-    if not all([image_url, animal, confidence, user_id]):
+    if not (image_url and animal and confidence and user_id):
         return jsonify({"error": "Missing required data (image_url, animal, confidence, or user_id)"}), 400
 
-    try:
-        # Insert record into database (labeled_images table)
-        record = {
-            "labeled_image_url": image_url,
-            "animal_detected": animal,
-            "confidence_score": float(confidence),
-            "user_id": user_id
-        }
+    if valid_confidence(confidence) is None:
+        return jsonify({"error": "confidence must be a number between 0 and 100"}), 400
 
-        supabase.table("labeled_images").insert(record).execute()
+    try:
+        save_record(image_url, animal, confidence, user_id)
 
         return jsonify({"status": "saved"}), 200
 
     except Exception as e:
-        print("Save history error:", e)
+        logger.exception("Save history error")
         return jsonify({"error": str(e)}), 500
 
 
@@ -137,46 +549,42 @@ def save_detection():
     if "image" not in request.files:
         return jsonify({"error": "No image uploaded"}), 400
 
-    file = request.files["image"]
-    animal = request.form.get("animal")
-    confidence = request.form.get("confidence")
-    user_id = request.form.get("user_id")
+    animal, confidence, user_id = map(
+        request.form.get, ("animal", "confidence", "user_id")
+    )
 
-    if not all([animal, confidence, user_id]):
+    if not (animal and confidence and user_id):
         return jsonify({"error": "Missing required data (animal, confidence, or user_id)"}), 400
 
+    if valid_confidence(confidence) is None:
+        return jsonify({"error": "confidence must be a number between 0 and 100"}), 400
+
+    file = request.files["image"]
+
     try:
         image_bytes = file.read()
-        mimetype = file.mimetype
-        # Using a folder-like path for "captured-images" bucket requirement if needed
-        # But the user asked for bucket "captured-images" specifically.
-        bucket = "captured-images"
-        filename = f"{int(time.time())}_{file.filename}"
-
-        # 1. Upload image to Supabase Storage
-        supabase.storage.from_(bucket).upload(
-            filename,
-            image_bytes,
-            {"content-type": mimetype}
-        )
+        filename = storage_filename(file.filename)
 
-        # 2. Get Public URL
-        public_url = supabase.storage.from_(bucket).get_public_url(filename)
-
-        # 3. Insert record into database (labeled_images table)
-        db_data = {
-            "labeled_image_url": public_url,
-            "animal_detected": animal,
-            "confidence_score": float(confidence),
-            "user_id": user_id
-        }
+        # Runs on the storage loop; wait so upload errors reach the caller
+        future = asyncio.run_coroutine_threadsafe(
+            upload_image(image_bytes, filename, file.mimetype, "captured-images", SAVE_SLOTS),
+            STORAGE_LOOP
+        )
+        try:
+            image_url = future.result(timeout=60)
+        except concurrent.futures.TimeoutError:
+            # Only stops an upload that has not been sent yet; one already
+            # received by Supabase stays stored, without a labeled_images row
+            future.cancel()
+            logger.warning("Save detection upload timed out: %s", filename)
+            return jsonify({"error": "Timed out uploading image to storage"}), 504
 
-        supabase.table("labeled_images").insert(db_data).execute()
+        save_record(image_url, animal, confidence, user_id)
 
         return jsonify({"status": "success", "message": "Detection saved to history"}), 200
 
     except Exception as e:
-        print("Save detection error:", e)
+        logger.exception("Save detection error")
         return jsonify({"error": str(e)}), 500
 
 
@@ -0,0 +1,15 @@
+import os
+from multiprocessing import cpu_count
+
+# =========================
+# GUNICORN CONFIG
+# =========================
+# /predict spends most of its time waiting on the HF Space, so each worker
+# runs a thread pool and serves many requests while they are in flight.
+# Start with: gunicorn -c gunicorn_conf.py app:app
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+workers = int(os.getenv("WEB_CONCURRENCY", 2 * cpu_count() + 1))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", 16))
+timeout = 150  # above the 120s HF model timeout
+keepalive = 5